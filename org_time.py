@@ -1,11 +1,25 @@
 from __future__ import annotations
-from orgparse import load, loads
-import sys
-from pprint import pprint
+from orgparse import load
+from orgparse.inline import to_plain_text
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass,field
+from datetime import datetime
+from functools import partial
+import hashlib
+import os
+import pickle
+import re
+import tempfile
 import time
 
-@dataclass
+## Parsed files are cached here, keyed by path and invalidated on parser/mtime/size change
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "org-clock-analyzer")
+CACHE_VERSION = 7
+## Entries already loaded by this process, a long running server only
+## has to stat the files to answer the next request
+LOADED = {}
+
+@dataclass(slots=True)
 class OrgNode:
     name: str
     level : int
@@ -16,46 +30,201 @@ class OrgNode:
     totalTime: int = 0
     totalFraction: float = 0.
     parentFraction: float = 0.
+
+
+## Picklable copy of the few orgparse node fields we actually use
+@dataclass(slots=True)
+class OrgEntry:
+    heading: str
+    level: int
+    tags: set
+    clock: list   # (start, end, hours) for every clock line
+    children: list = field(default_factory=lambda: [])
+    clocked: bool = False   # any clock line in this subtree
     
 
+def to_entry(node):
+    ## Durations are worked out once here, windows only need to filter and sum them.
+    ## A running clock has no end yet and doesn't count
+    clock = [(cl.start, cl.end, (cl.end - cl.start).total_seconds() / (60*60))
+             for cl in getattr(node, "clock", ()) if cl.end is not None]
+    children = [to_entry(ch) for ch in node.children]
+    return OrgEntry(heading=node.heading,
+                    level=node.level,
+                    tags=node.tags,
+                    clock=clock,
+                    children=children,
+                    clocked=bool(clock) or any(ch.clocked for ch in children))
+
+
+## Same rules as orgparse for the few bits of syntax we need
+HEADING_RE = re.compile(r'^(\*+)\s+(.*?)\s*$')
+HEADING_TAGS_RE = re.compile(r'(.*?)\s*:([\w@:]+):\s*$')
+HEADING_PRIORITY_RE = re.compile(r'^\s*\[#([A-Z0-9])\] ?(.*)$')
+COMMENT_RE = re.compile(r'^\s*#\+([^:]*):(.*)$')
+CLOCK_RE = re.compile(r'^(?!#).*CLOCK:\s+'
+                      r'\[(\d+)\-(\d+)\-(\d+)[^\]\d]*(\d+)\:(\d+)\]'
+                      r'--\[(\d+)\-(\d+)\-(\d+)[^\]\d]*(\d+)\:(\d+)\]\s+=>\s+\d+\:\d+')
+
+
+def todo_keywords(lines):
+    todos, dones, found = [], [], False
+    for line in lines:
+        m = COMMENT_RE.match(line)
+        if m and m.group(1).upper() in ("TODO", "SEQ_TODO", "TYP_TODO"):
+            found = True
+            line_todos, _, line_dones = m.group(2).strip().partition("|")
+            todos += [k.split("(", 1)[0] for k in line_todos.split()]
+            dones += [k.split("(", 1)[0] for k in line_dones.split()]
+    return todos + dones if found else ["TODO", "DONE"]
+
+
+def scan_file(path):
+    ## Build the OrgEntry tree straight from the headings and CLOCK lines,
+    ## skipping everything else orgparse would parse for us
+    with open(path, encoding="utf8") as f:
+        text = f.read()
+    lines = text.split("\n")
+    keywords = todo_keywords(lines) if "#+" in text else ["TODO", "DONE"]
+    filetags = []
+    for line in lines:
+        if line.startswith("*") and line.lstrip("*").startswith(" "): break
+        m = COMMENT_RE.match(line)
+        if m and m.group(1).upper() == "FILETAGS":
+            filetags += [t.strip() for t in m.group(2).split(":") if t.strip()]
+    root = OrgEntry(heading="", level=0, tags=set(filetags), clock=[])
+    stack = [root]
+    for line in lines:
+        if line.startswith("*") and line.lstrip("*").startswith(" "):
+            stars, heading = HEADING_RE.match(line).groups()
+            level = len(stars)
+            tags = []
+            m = HEADING_TAGS_RE.match(heading)
+            if m:
+                heading, tags = m.group(1), m.group(2).split(":")
+            for kw in keywords:
+                if heading == kw or heading.startswith(kw + " "):
+                    heading = heading[len(kw) + 1:]
+                    break
+            m = HEADING_PRIORITY_RE.match(heading)
+            if m:
+                heading = m.group(2)
+            ## Links show their description, as in orgparse's plain heading
+            if "[[" in heading:
+                heading = to_plain_text(heading)
+            while stack[-1].level >= level:
+                stack.pop()
+            entry = OrgEntry(heading=heading,
+                             level=level,
+                             tags=set(tags) | stack[-1].tags,
+                             clock=[])
+            stack[-1].children.append(entry)
+            stack.append(entry)
+        elif len(stack) > 1 and "CLOCK:" in line:
+            m = CLOCK_RE.match(line)
+            if m:
+                groups = [int(g) for g in m.groups()]
+                start, end = datetime(*groups[:5]), datetime(*groups[5:])
+                stack[-1].clock.append((start, end, (end - start).total_seconds() / (60*60)))
+                for entry in reversed(stack):
+                    if entry.clocked: break
+                    entry.clocked = True
+    return root
+
+
+def cache_stamp(path, use_orgparse=False):
+    st = os.stat(path)
+    cache_file = os.path.join(CACHE_DIR, hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + ".pkl")
+    ## The parser is part of the stamp: switching it is a miss, not a stale hit
+    return cache_file, (CACHE_VERSION, use_orgparse, st.st_mtime_ns, st.st_size)
+
+
+def read_cache(path, use_orgparse=False):
+    cache_file, stamp = cache_stamp(path, use_orgparse)
+    if path in LOADED and LOADED[path][0] == stamp:
+        return LOADED[path][1]
+    try:
+        with open(cache_file, "rb") as fc:
+            cached_stamp, entry = pickle.load(fc)
+        if cached_stamp == stamp:
+            LOADED[path] = (stamp, entry)
+            return entry
+    except Exception:
+        ## Only a cache: anything unreadable is just a miss
+        pass
+    return None
+
+
+def parse_file(path, use_orgparse=False):
+    cache_file, stamp = cache_stamp(path, use_orgparse)
+    entry = to_entry(load(path)) if use_orgparse else scan_file(path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        ## Write aside and rename, a concurrent reader never sees half a record
+        fd, tmp_file = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fc:
+                pickle.dump((stamp, entry), fc, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+    except OSError:
+        pass
+    return stamp, entry
+
+
+def clock_time(node, start_time=None, end_time=None):
+    return sum((hours for start, end, hours in node.clock
+                if (not start_time or start >= start_time) and (not end_time or end <= end_time)), 0.)
+
+
 def explore(parent, node, start_time=None, end_time=None):
-    localT = 0.
-    if hasattr(node, "clock"):
-        for cl in node.clock:
-            if start_time:
-                if cl.start < start_time: continue
-            if end_time:
-                if cl.end > end_time: continue
-            localT += (cl.end - cl.start).seconds / (60*60)
-    #print("Loading: ", node.heading)
-    orgnode = OrgNode(name=node.heading,
-                      level=node.level,
-                      localTime=localT,
-                      totalTime=localT,
-                      tags=node.tags,
-                      parent=parent)
-    parent.children.append(orgnode)
-    for children in node.children:
-        explore(orgnode, children, start_time, end_time)
-
-#Now traverse to get the total time
-def add_time(node):
-    for ch in node.children:
-        add_time(ch)
-    if node.parent:
-        node.parent.totalTime += node.totalTime
-
-
-def relative_time(node, total, parent):
-    node.totalFraction = node.totalTime/total
-    node.parentFraction = node.totalTime/parent
-    if node.totalTime == 0: return
-    for ch in node.children:
-        relative_time(ch, total, node.totalTime)
-
-
-def get_json_time(node):
-    if len(node.children):
+    ## Iterative walk: each node is visited a second time once all of its
+    ## children are done, and its total is then added to the parent's
+    stack = [(parent, node, None)]
+    while stack:
+        parent, node, orgnode = stack.pop()
+        if orgnode is not None:
+            parent.totalTime += orgnode.totalTime
+            continue
+        localT = clock_time(node, start_time, end_time)
+        #print("Loading: ", node.heading)
+        orgnode = OrgNode(name=node.heading,
+                          level=node.level,
+                          localTime=localT,
+                          totalTime=localT,
+                          tags=node.tags,
+                          parent=parent)
+        parent.children.append(orgnode)
+        stack.append((parent, node, orgnode))
+        ## Subtrees without a single clock line can never have any time
+        for ch in reversed(node.children):
+            if ch.clocked:
+                stack.append((orgnode, ch, None))
+
+
+def relative_time(root):
+    total = root.totalTime
+    root.totalFraction = root.parentFraction = 1.
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for ch in node.children:
+            ch.totalFraction = ch.totalTime/total
+            ch.parentFraction = ch.totalTime/node.totalTime
+            if ch.totalTime > 0:
+                stack.append(ch)
+
+
+def get_json_time(node, total=None):
+    if total is None:
+        ## Grand total, worked out once for the whole tree
+        total = node.totalTime / node.totalFraction if node.totalFraction else node.totalTime
+    ## Nodes without time in the window have zero size in the chart:
+    ## don't ship them to the frontend
+    children = [ch for ch in node.children if ch.totalTime > 0]
+    if len(children):
         obj = {
             "name": node.name,
             "children": [
@@ -66,34 +235,56 @@ def get_json_time(node):
         if node.localTime > 0:
             obj["children"].append({
                 "name":"self",
-                "value": node.localTime,
-                "relTot": f"{100*node.localTime / (node.totalTime/ node.totalFraction) :.3f}",
+                "value": round(node.localTime, 3),
+                "relTot": f"{100*node.localTime / total :.3f}",
                 "relParent": f"{100*node.localTime/node.totalTime:.3f}"
             })
-        for ch in node.children:
-            obj["children"].append(get_json_time(ch))
+        for ch in children:
+            obj["children"].append(get_json_time(ch, total))
         return obj
     else:
         return {
             "name": node.name,
-            "value": node.totalTime,
+            "value": round(node.totalTime, 3),
             "relTot": f"{100*node.totalFraction:.3f}",
             "relParent": f"{100*node.parentFraction:.3f}"
         }
 
 
 
-def load_files(files, start_time=None, end_time=None):
-    t0 = time.time()
+def parse_files(files, use_orgparse=False, parallel=False):
+    ## Parse every file once: the result can be sliced by build_tree
+    ## for as many time windows as needed without touching the disk again.
+    ## Unchanged files are read back from the cache instead of re-parsed.
+    ## With parallel the others are parsed side by side in worker processes:
+    ## only worth it with several misses and cores, and not from inside a
+    ## threaded server that would have to fork itself
+    entries = {f: read_cache(f, use_orgparse) for f in files}
+    missing = [f for f, entry in entries.items() if entry is None]
+    workers = min(len(missing), os.cpu_count() or 1)
+    if parallel and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            LOADED.update(zip(missing, ex.map(partial(parse_file, use_orgparse=use_orgparse), missing)))
+    else:
+        LOADED.update((f, parse_file(f, use_orgparse)) for f in missing)
+    entries.update((f, LOADED[f][1]) for f in missing)
+    return [(f.split("/")[-1][:-4], entries[f]) for f in files]
+
+
+def build_tree(parsed, start_time=None, end_time=None):
     clock_root  = OrgNode(name="root", parent=None, level=-1 ) 
-    for f in files:
-        node = load(f)
+    for name, node in parsed:
         explore(clock_root, node, start_time, end_time)
-        clock_root.children[-1].name = f.split("/")[-1][:-4]
-    ## Accumulate the time
-    add_time(clock_root)
-    ## Compute relative time
-    relative_time(clock_root, clock_root.totalTime, clock_root.totalTime)
+        clock_root.children[-1].name = name
+    ## Compute relative time, nothing to share out for an empty window
+    if clock_root.totalTime > 0:
+        relative_time(clock_root)
+    return clock_root
+
+
+def load_files(files, start_time=None, end_time=None, use_orgparse=False, parallel=False):
+    t0 = time.time()
+    clock_root = build_tree(parse_files(files, use_orgparse, parallel), start_time, end_time)
     t1 = time.time()
     print(f"Loaded in {t1-t0:.4f} s")
     return clock_root
@@ -105,8 +296,9 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--files",  nargs="+", type=str , help="input files")
+    parser.add_argument("--orgparse", action="store_true", help="parse the files with orgparse instead of the built-in scanner")
     args = parser.parse_args()
-    clock_root = load_files(args.files)
+    clock_root = load_files(args.files, use_orgparse=args.orgparse, parallel=True)
     output = get_json_time(clock_root)
 
     
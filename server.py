@@ -1,6 +1,4 @@
 from flask import Flask, request
-from flask import g
-import time
 from flask_cors import CORS
 from datetime import datetime
 
@@ -9,6 +7,16 @@ from org_time import load_files, get_json_time
 app = Flask(__name__)
 CORS(app)
 
+ORG_FILES = [
+    "/home/valsdav/org/Clustering.org",
+    "/home/valsdav/org/ETH.org",
+    "/home/valsdav/org/CMS.org",
+    "/home/valsdav/org/ttHbb.org",
+    "/home/valsdav/org/Mails.org",
+    "/home/valsdav/org/Publications.org",
+    "/home/valsdav/org/Meetings.org"
+]
+
 
 @app.route("/data")
 def get_data():
@@ -19,14 +27,5 @@ def get_data():
         start_time = datetime.fromisoformat(start_time)
     if end_time:
         end_time = datetime.fromisoformat(end_time)
-    files = [
-        "/home/valsdav/org/Clustering.org",
-        "/home/valsdav/org/ETH.org",
-        "/home/valsdav/org/CMS.org",
-        "/home/valsdav/org/ttHbb.org",
-        "/home/valsdav/org/Mails.org",
-        "/home/valsdav/org/Publications.org",
-        "/home/valsdav/org/Meetings.org"
-    ]
-    clock_root = load_files(files, start_time, end_time)
+    clock_root = load_files(ORG_FILES, start_time, end_time)
     return get_json_time(clock_root)
@@ -0,0 +1,19 @@
+from org_time import load, scan_file, to_entry
+
+ORG_TEXT = """#+TODO: TODO NEXT | DONE CANCELED
+#+FILETAGS: :mail:
+
+* TODO [[https://example.com][Linked task]] :work:
+  CLOCK: [2023-05-02 Tue 09:00]--[2023-05-02 Tue 10:30] =>  1:30
+** NEXT [#A] Plain [[file:notes.org]]
+   CLOCK: [2023-05-03 Wed 14:00]--[2023-05-03 Wed 14:45] =>  0:45
+** CANCELED Nothing clocked here :meeting:
+* DONE [#B] Reply to [[mu4e:msgid:1234@example.com][a mail]] :mail:home:
+  CLOCK: [2023-05-04 Thu 08:15]--[2023-05-04 Thu 09:00] =>  0:45
+"""
+
+
+def test_scan_file_matches_orgparse(tmp_path):
+    path = tmp_path / "sample.org"
+    path.write_text(ORG_TEXT, encoding="utf8")
+    assert scan_file(str(path)) == to_entry(load(str(path)))